@@ -1,175 +1,403 @@
 from webbrowser import get
-import wikipediaapi 
 import pandas as pd
+import asyncio
 import concurrent.futures
+import aiohttp
+from aiolimiter import AsyncLimiter
+import functools
+import hashlib
+import logging
+import math
+import os
+import orjson
 from tqdm import tqdm
 import re
+import tempfile
 import spacy
-import neuralcoref
+from spacy.tokens import DocBin
+from fastcoref import spacy_component  # registers the fastcoref pipeline factory
 import requests
+from requests.adapters import HTTPAdapter
 import time 
 from pathlib import Path
-from bs4 import BeautifulSoup
+from selectolax.parser import HTMLParser
+
+log = logging.getLogger(__name__)
+
+API_URL = 'https://en.wikipedia.org/w/api.php'
+
+# fixed parameters of each kind of MediaWiki call, call sites only add the page titles
+_EXTRACT_PARAMS = {
+        'action': 'query',
+        'format': 'json',
+        'prop': 'extracts',
+        'exintro': 1,
+        'explaintext': 1,
+    }
+_BULK_EXTRACT_PARAMS = {**_EXTRACT_PARAMS, 'exlimit': 'max', 'redirects': ''}
+_LINKS_PARAMS = {
+        'action': 'query',
+        'format': 'json',
+        'prop': 'links',
+        'pllimit': 'max',
+        'redirects': '',
+    }
+_PARSE_PARAMS = {
+        'action': 'parse',
+        'prop': 'text',
+        'format': 'json',
+        'redirects': '',
+    }
+_CONTENTS_PARAMS = {
+        'action': 'query',
+        'format': 'json',
+        'prop': 'extracts|info|categories',
+        'explaintext': 1,
+        'exsectionformat': 'plain',
+        'inprop': 'url',
+        'cllimit': 'max',
+        'redirects': '',
+    }
+
+_NEWLINES = re.compile(r'\n+')
+_REFS = re.compile(r'\[\d+\]')
+
+@functools.lru_cache(maxsize=1)
+def _get_nlp():
+    ''' Load the spacy pipeline with fastcoref once and share it between all FinalCode objects
+    Returns: 
+        Language: en_core_web_sm pipeline with the fastcoref component added'''
+    nlp = spacy.load('en_core_web_sm', exclude=['lemmatizer'])  # lemmas are never used
+    nlp.add_pipe('fastcoref', config={'model_architecture': 'FCoref'})
+    return nlp
+
+def text_links(html):
+    ''' Collect the titles of wiki links found in the paragraphs of a page
+    Args: 
+        html (str): parsed html of a wikipedia page
+        
+    Returns: 
+        list (str): containing page titles of all links found in the paragraphs'''
+    links = []
+    for tag in HTMLParser(html).css('p a[href]'):   # anchors with an href inside paragraphs
+        title = tag.attributes.get('title')
+        if not tag.text() == '' and 'wiki' in (tag.attributes.get('href') or '') and title:
+            links.append(title)
+
+    return links
+
+# prop=extracts only returns this many intro extracts per query (exlimit)
+MAX_EXTRACT_TITLES = 20
+
+def map_abstracts(titles, data, abstracts, resolved=None):
+    ''' Match the pages of a batched extracts query back to the titles that were requested
+    Args: 
+        titles (list (str)): page titles sent in the query
+        data (dict): decoded json response of the query
+        abstracts (dict): title to abstract mapping that found abstracts are added to
+        resolved (dict): optional title to article title mapping, redirects and spelling variants are added to it'''
+    query = data['query']
+    found = {page['title']: page['extract'] for page in query['pages'].values()
+             if 'extract' in page}
+
+    # titles come back normalized and redirects resolved, so follow both aliases
+    aliases = {}
+    for alias in query.get('normalized', []) + query.get('redirects', []):
+        aliases[alias['from']] = alias['to']
+
+    for title in titles:
+        target = aliases.get(title, title)
+        target = aliases.get(target, target)
+        if target in found:
+            abstracts[title] = found[target]
+            if resolved is not None:
+                resolved[title] = target
+
+def run_coroutine(coro):
+    ''' Run a coroutine to completion from synchronous code, also where an event loop is already running
+    Args: 
+        coro (coroutine): coroutine to run
+        
+    Returns: 
+        result of the coroutine'''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    # e.g. jupyter already runs a loop in this thread, so give the coroutine its own loop in a worker thread
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+def cached_doc_path(cache_dir, page_name):
+    ''' Find where the parsed abstract of a wikipedia page is cached
+    Args: 
+        cache_dir (str): directory parsed abstracts are cached in
+        page_name (str): name of the wikipedia page
+        
+    Returns: 
+        Path: DocBin file of the page inside cache_dir'''
+    key = hashlib.blake2b(page_name.encode()).hexdigest()[:16]
+    return Path(cache_dir) / '{}.spacy'.format(key)
+
+def save_cached_doc(doc_path, doc):
+    ''' Cache a parsed abstract, writing a temporary file first so an interrupted run never leaves a partial cache file
+    Args: 
+        doc_path (Path): DocBin file to cache the doc in, from cached_doc_path
+        doc (Doc): parsed abstract'''
+    data = DocBin(docs=[doc]).to_bytes()
+    # a leftover .tmp file is never mistaken for a cached doc, only the finished file is moved into place
+    with tempfile.NamedTemporaryFile(dir=doc_path.parent, suffix='.tmp', delete=False) as tmp:
+        tmp.write(data)
+    os.replace(tmp.name, doc_path)
+
+def load_cached_doc(doc_path, vocab):
+    ''' Read back a parsed abstract cached by save_cached_doc
+    Args: 
+        doc_path (Path): DocBin file the doc is cached in, from cached_doc_path
+        vocab (Vocab): vocab of the pipeline the doc was parsed with
+        
+    Returns: 
+        Doc: cached abstract, None if it is not cached or the cache file cannot be read'''
+    try:
+        return next(DocBin().from_disk(doc_path).get_docs(vocab))
+    except Exception as e:
+        if doc_path.exists():
+            log.warning('Ignoring unreadable cache file %s: %s', doc_path, e)
+        return None
 
 class FinalCode:
 
     def __init__(self, page_name):
         self.page_name = page_name
-        self.nlp = spacy.load('en_core_web_sm')
-        neuralcoref.add_to_pipe(self.nlp)
+        # one keep-alive connection pool for every synchronous request made by this object
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
 
-    def extract_abstract(self): 
+    def extract_abstract(self, page_name=None): 
         ''' Extract only abstract from a wikipedia page
         Args: 
-            page_name (str): name of the wikipedia page
+            page_name (str): name of the wikipedia page, defaults to the page this object was created with
             
         Returns: 
             String: abstract of wikipedia page'''
 
-        subject = self.page_name
-        url = 'https://en.wikipedia.org/w/api.php'
-        params = {
-                'action': 'query',
-                'format': 'json',
-                'titles': subject,
-                'prop': 'extracts',
-                'exintro': True,
-                'explaintext': True,
-            }
+        subject = page_name or self.page_name
+        params = {**_EXTRACT_PARAMS, 'titles': subject}
         
-        response = requests.get(url, params=params)
-        data = response.json()
+        response = self._session.get(API_URL, params=params)
+        data = orjson.loads(response.content)
         
         page = next(iter(data['query']['pages'].values()))
 
         return page['extract']
 
-    def extract_all_links(self): 
+    def extract_abstracts_bulk(self, titles, resolved=None):
+        ''' Extract the abstracts of many wikipedia pages, batching titles into as few requests as possible
+        Args: 
+            titles (list (str)): names of the wikipedia pages
+            resolved (dict): optional dict the article title each found title resolves to is added to
+            
+        Returns: 
+            dict: abstract of each wikipedia page keyed by the requested title, missing pages are left out'''
+        abstracts = {}
+
+        for i in range(0, len(titles), MAX_EXTRACT_TITLES):
+            chunk = titles[i:i + MAX_EXTRACT_TITLES]
+            params = {**_BULK_EXTRACT_PARAMS, 'titles': '|'.join(chunk)}
+
+            while True:
+                data = orjson.loads(self._session.get(API_URL, params=params).content)
+                map_abstracts(chunk, data, abstracts, resolved)
+                if 'continue' not in data:
+                    break
+                params.update(data['continue'])
+
+        return abstracts
+
+    def extract_all_links(self, page_name=None): 
         ''' Extract all the links from a wikipedia page
         Args: 
-            page_name (str): name of the wikipedia page
+            page_name (str): name of the wikipedia page, defaults to the page this object was created with
             
         Returns: 
             list (str): containing page titles of all 
             links on original page''' 
-        subject = self.page_name
-        
-        url = 'https://en.wikipedia.org/w/api.php'
+        subject = page_name or self.page_name
         
-        params = {
-            'action': 'query',
-            'format': 'json',
-            'titles': subject,
-            'prop': 'links',
-            'pllimit': 'max',
-            'redirects':''
-        }
-        
-        response = requests.get(url=url, params=params)
-        data = response.json()
-        
-        pages = data['query']['pages']
-        page = 1
+        params = {**_LINKS_PARAMS, 'titles': subject}
+
         page_titles = []
-        
-        try: 
-            for key, val in pages.items():
-                for link in val['links']:
-                    page_titles.append(link['title'])
-        except: 
-            return page_titles
-        
-        while 'continue' in data:
-            plcontinue = data['continue']['plcontinue']
-            params['plcontinue'] = plcontinue
-        
-            response = requests.get(url=url, params=params)
-            data = response.json()
-            pages = data['query']['pages']
-        
-            page += 1
-        
-            for key, val in pages.items():
-                for link in val['links']:
-                    page_titles.append(link['title'])
-        
-        return page_titles
+        append = page_titles.append
+        while True:
+            response = self._session.get(API_URL, params=params)
+            data = orjson.loads(response.content)
+
+            # pages without links have no 'links' key
+            for val in data['query']['pages'].values():
+                for link in val.get('links', ()):
+                    append(link['title'])
 
-    def extract_text_links(self, abstract_only=False):
+            if 'continue' not in data:
+                return page_titles
+            params['plcontinue'] = data['continue']['plcontinue']
+
+    def extract_text_links(self, page_name=None, abstract_only=False):
         ''' Extract all links from only the text of a wikipedia page
         Args: 
-            page_name (str): name of the wikipedia page
+            page_name (str): name of the wikipedia page, defaults to the page this object was created with
             abstract_only (bool): true if only extracting links from just abstract of page, false if all text
             
         Returns: 
             list (str): containing page titles of all links found in text or abstract only of page'''
-        subject = self.page_name
-        
-        url = 'https://en.wikipedia.org/w/api.php'
-        params = {
-                    'action':'parse',
-                    'prop':'text',
-                    'format':'json',
-                    'page':subject,
-                    'section':0,
-                    'redirects':''
-                }
-
-        if not abstract_only:
-            del params['section']
-
-        data = requests.get(url, params=params).json()
+        subject = page_name or self.page_name
         
-        soup = BeautifulSoup(data['parse']['text']['*'],'html.parser')
+        params = {**_PARSE_PARAMS, 'page': subject}
+        if abstract_only:
+            params['section'] = 0
 
-        test = soup.find_all('p')
-
-        a_tags = []
-        for paragraph in test: 
-            p_tags = paragraph.find_all('a',href=True)
-            for tag in p_tags:
-                a_tags.append(tag) 
-        
-        links = []
-        for tag in a_tags:
-            if not tag.text == '' and 'wiki' in tag['href']:
-                links.append(tag['title'])
+        data = orjson.loads(self._session.get(API_URL, params=params).content)
+        links = text_links(data['parse']['text']['*'])
         
-        print(len(links))
+        log.debug('Text links found: %d', len(links))
         return links
 
-    def extract_contents(self):
-        ''' Extract all the contents from a wikipedia page
+    async def extract_abstract_async(self, session, page_name):
+        ''' Asynchronous version of extract_abstract that reuses a shared HTTP session
+        Args: 
+            session (aiohttp.ClientSession): session whose connection pool is shared by all requests
+            page_name (str): name of the wikipedia page
+            
+        Returns: 
+            String: abstract of wikipedia page'''
+        params = {**_EXTRACT_PARAMS, 'titles': page_name}
+
+        async with session.get(API_URL, params=params) as response:
+            data = orjson.loads(await response.read())
+
+        page = next(iter(data['query']['pages'].values()))
+
+        return page['extract']
+
+    async def extract_abstracts_bulk_async(self, session, titles, limiter=None, resolved=None):
+        ''' Asynchronous version of extract_abstracts_bulk that issues the batched requests concurrently
+        Args: 
+            session (aiohttp.ClientSession): session whose connection pool is shared by all requests
+            titles (list (str)): names of the wikipedia pages
+            limiter (AsyncLimiter): optional rate limit every request waits on
+            resolved (dict): optional dict the article title each found title resolves to is added to
+            
+        Returns: 
+            dict: abstract of each wikipedia page keyed by the requested title, missing pages are left out'''
+        abstracts = {}
+
+        async def fetch(chunk):
+            params = {**_BULK_EXTRACT_PARAMS, 'titles': '|'.join(chunk)}
+
+            try:
+                while True:
+                    if limiter is not None:
+                        await limiter.acquire()
+                    async with session.get(API_URL, params=params) as response:
+                        data = orjson.loads(await response.read())
+                    map_abstracts(chunk, data, abstracts, resolved)
+                    if 'continue' not in data:
+                        return
+                    params.update(data['continue'])
+            except Exception as e:   # the pages of a failed batch are skipped like any other bad page
+                log.error('error: %s', e)
+
+        await asyncio.gather(*(fetch(titles[i:i + MAX_EXTRACT_TITLES])
+                               for i in range(0, len(titles), MAX_EXTRACT_TITLES)))
+
+        return abstracts
+
+    async def extract_all_links_async(self, session, page_name):
+        ''' Asynchronous version of extract_all_links that reuses a shared HTTP session
+        Args: 
+            session (aiohttp.ClientSession): session whose connection pool is shared by all requests
+            page_name (str): name of the wikipedia page
+            
+        Returns: 
+            list (str): containing page titles of all 
+            links on original page''' 
+        params = {**_LINKS_PARAMS, 'titles': page_name}
+
+        page_titles = []
+        append = page_titles.append
+        while True:
+            async with session.get(API_URL, params=params) as response:
+                data = orjson.loads(await response.read())
+
+            # pages without links have no 'links' key
+            for val in data['query']['pages'].values():
+                for link in val.get('links', ()):
+                    append(link['title'])
+
+            if 'continue' not in data:
+                return page_titles
+            params['plcontinue'] = data['continue']['plcontinue']
+
+    async def extract_text_links_async(self, session, page_name, abstract_only=False):
+        ''' Asynchronous version of extract_text_links that reuses a shared HTTP session
         Args: 
+            session (aiohttp.ClientSession): session whose connection pool is shared by all requests
             page_name (str): name of the wikipedia page
+            abstract_only (bool): true if only extracting links from just abstract of page, false if all text
+            
+        Returns: 
+            list (str): containing page titles of all links found in text or abstract only of page'''
+        params = {**_PARSE_PARAMS, 'page': page_name}
+        if abstract_only:
+            params['section'] = 0
+
+        async with session.get(API_URL, params=params) as response:
+            data = orjson.loads(await response.read())
+
+        return text_links(data['parse']['text']['*'])
+
+    def extract_contents(self, page_name=None):
+        ''' Extract all the contents from a wikipedia page
+        Args: 
+            page_name (str): name of the wikipedia page, defaults to the page this object was created with
             
         Returns: 
             dataframe: contains page name, text, url, and 
             categories of page'''
 
+        params = {**_CONTENTS_PARAMS, 'titles': page_name or self.page_name}
+
         try:
-            # get page with wikipedia-api package
-            wiki_api = wikipediaapi.Wikipedia(language='en',
-                    extract_format=wikipediaapi.ExtractFormat.WIKI)
-            page_name = wiki_api.page(self.page_name)
+            # text, url and categories all come from one query, only long category lists continue
+            text, link, categories = None, None, []
+            while True:
+                data = orjson.loads(self._session.get(API_URL, params=params).content)
+                page = next(iter(data['query']['pages'].values()))
+
+                # check existence to catch errors 
+                if 'missing' in page or 'invalid' in page:
+                    #print('Page {} does not exist.'.format(page_name))
+                    return
+
+                text = page.get('extract', text)
+                link = page.get('fullurl', link)
+                categories += [y['title'][9:] for y in page.get('categories', [])]
 
-            # check existence to catch errors 
-            if not page_name.exists():
-                #print('Page {} does not exist.'.format(page_name))
-                return
+                if 'continue' not in data:
+                    break
+                params.update(data['continue'])
 
             # creation of pandas dataframe 
             page_data = pd.DataFrame({
-                'page': page_name,
-                'text': page_name.text,
-                'link': page_name.fullurl,
-                'categories': [[y[9:] for y in
-                            list(page_name.categories.keys())]],
+                'page': page['title'],
+                'text': text,
+                'link': link,
+                'categories': [categories],
                 })
 
             return page_data
         except:
-            print("Page content not found.")
+            log.warning("Page content not found.")
             return None 
 
     # gets entity pairs in given text 
@@ -177,6 +405,7 @@ class FinalCode:
         ''' Extracts all subject, object, relation triples from given text 
         Args: 
             text (str): all text in wikipedia page 
+            coref (bool): True to resolve coreference clusters before extracting triples
             
         Returns: 
             dataframe: columns containing subject, object, relation triples, the type of subject, and
@@ -184,12 +413,57 @@ class FinalCode:
 
         if text is None: 
             return 
+
+        return self.get_doc_pairs(self.parse_text(text, coref))
+
+    def parse_text(self, text, coref=True):
+        ''' Cleans and parses given text, resolving coreference clusters first
+        Args: 
+            text (str): all text in wikipedia page 
+            coref (bool): True to resolve coreference clusters before parsing
+            
+        Returns: 
+            Doc: parsed text that triples can be extracted from with get_doc_pairs'''
+        return next(iter(self.parse_texts([text], coref)))
+
+    def parse_texts(self, texts, coref=True, n_process=1, batch_size=32):
+        ''' Cleans and parses many texts in batches, resolving coreference clusters first
+        Args: 
+            texts (list (str)): texts of wikipedia pages
+            coref (bool): True to resolve coreference clusters before parsing
+            n_process (int): most processes the parse is spread over, never more than there are batches, -1 for all cpu cores
+            batch_size (int): number of texts sent through the pipeline at once
+            
+        Returns: 
+            generator (Doc): parsed texts in the order given, triples can be extracted from them with get_doc_pairs'''
+        nlp = _get_nlp()
+        if n_process == -1:   # spacy's convention for all cores
+            n_process = os.cpu_count() or 1
+        elif n_process < 1:
+            raise ValueError('n_process must be -1 or at least 1, got {}'.format(n_process))
+        # forking only pays off with several batches, a small neighbor is parsed in this process
+        n_process = max(1, min(n_process, math.ceil(len(texts) / batch_size)))
         # preprocess text
-        text = re.sub(r'\n+', '.', text)  # replace multiple newlines with period
-        text = re.sub(r'\[\d+\]', ' ', text)  # remove reference numbers
-        text = self.nlp(text)
+        texts = (_REFS.sub(' ', _NEWLINES.sub('.', text))   # newlines to periods, remove reference numbers
+                 for text in texts)
+        # fastcoref only needs tokens and pos tags, and the reparse of the resolved text does not need fastcoref
         if coref:
-            text = self.nlp(text._.coref_resolved)  # resolve coreference clusters
+            # the coref model batches on its own and stays in this process, only the parse is forked
+            resolved = nlp.pipe(texts, batch_size=batch_size, disable=['parser', 'ner'],
+                                component_cfg={'fastcoref': {'resolve_text': True}})
+            texts = (doc._.resolved_text for doc in resolved)  # resolve coreference clusters
+
+        return nlp.pipe(texts, batch_size=batch_size, n_process=n_process, disable=['fastcoref'])
+
+    def get_doc_pairs(self, doc):
+        ''' Extracts all subject, object, relation triples from parsed text, the doc is retokenized in place
+        Args: 
+            doc (Doc): text parsed by parse_text
+            
+        Returns: 
+            dataframe: columns containing subject, object, relation triples, the type of subject, and
+            type of object found in the entity'''
+        nlp = _get_nlp()
 
         def refine_ent(ent, sent):
             unwanted_tokens = (
@@ -205,32 +479,43 @@ class FinalCode:
             if ent_type == '':
                 ent_type = 'NOUN_CHUNK'
                 ent = ' '.join(str(t.text) for t in
-                            self.nlp(str(ent)) if t.pos_
-                            not in unwanted_tokens and t.is_stop == False)
+                            nlp(str(ent), disable=['parser', 'ner', 'fastcoref']) if t.pos_
+                            not in unwanted_tokens and t.is_stop == False)  # only pos tags are needed
             elif ent_type in ('NOMINAL', 'CARDINAL', 'ORDINAL') and str(ent).find(' ') == -1:
-                refined = ''
-                for i in range(len(sent) - ent.i):
-                    if ent.nbor(i).pos_ not in ('VERB', 'PUNCT'):
-                        refined += ' ' + str(ent.nbor(i))
+                refined = []
+                for i in range(sent.end - ent.i):
+                    nbor = ent.nbor(i)
+                    if nbor.pos_ not in ('VERB', 'PUNCT'):
+                        refined.append(nbor.text)
                     else:
-                        ent = refined.strip()
+                        ent = ' '.join(refined)
                         break
 
             return ent, ent_type
 
-        sentences = [sent.string.strip() for sent in text.sents]  # split text into sentences
-        ent_pairs = []
-        for sent in sentences:
-            sent = self.nlp(sent)
+        # reuse the parse of the whole text instead of reparsing every sentence, sentences are kept
+        # as character offsets since merging spans shifts token indices
+        sentences = []
+        for sent in doc.sents:  # split text into sentences
             spans = list(sent.ents) + list(sent.noun_chunks)  # collect nodes
+            if not spans:   # no subject or object can come from this sentence, skip its token walk
+                continue
             spans = spacy.util.filter_spans(spans)
-            with sent.retokenize() as retokenizer:
-                [retokenizer.merge(span, attrs={'tag': span.root.tag,
-                                                'dep': span.root.dep}) for span in spans]
+            sentences.append((sent.start_char, sent.end_char, spans,
+                              {span.start_char for span in spans}))  # each span becomes one token starting here
+
+        with doc.retokenize() as retokenizer:
+            [retokenizer.merge(span, attrs={'tag': span.root.tag,
+                                            'dep': span.root.dep})
+             for _, _, spans, _ in sentences for span in spans]
+
+        ent_pairs = []
+        for start_char, end_char, spans, span_starts in sentences:
+            sent = doc.char_span(start_char, end_char)
             deps = [token.dep_ for token in sent]
 
             for token in sent:
-                if str(token) in str(spans):  # only look through sentence objects 
+                if token.idx in span_starts:  # only look through sentence objects 
                     subject = [w for w in token.head.lefts if w.dep_
                             in ('subj', 'nsubj')]  # identify subject nodes
                     if subject:
@@ -243,10 +528,11 @@ class FinalCode:
                             relation = relation[0]
                             if not relation.is_punct: 
                             # add adposition or particle to relationship
-                                try: 
+                                # the next token has to be in the same sentence, the last token has no neighbor
+                                if relation.i + 1 < sent.end:
                                     if relation.nbor(1).pos_ in ('ADP', 'PART'):
                                         relation = ' '.join((str(relation), str(relation.nbor(1))))
-                                except: 
+                                else: 
                                     relation = 'unknown'
                         else:
                             relation = 'unknown'
@@ -261,11 +547,11 @@ class FinalCode:
                             if not any(str(ent) == '' for ent in sublist)]
         pairs = pd.DataFrame(ent_pairs, columns=['subject', 'relation', 'object',
                                                 'subject_type', 'object_type'])
-        print('Entity pairs extracted:', str(len(ent_pairs)))
+        log.debug('Entity pairs extracted: %d', len(ent_pairs))
 
         return pairs
 
-    def recursive_get_wiki_pairs(self, k, path, verbose=True):
+    def recursive_get_wiki_pairs(self, k, path, verbose=True, cache_dir=None, n_process=None):
         ''' Recrusively extracts triples from given page and triples k neighbor sources from the original page
         Args: 
             page_name (str): name of the wikipedia page
@@ -273,80 +559,171 @@ class FinalCode:
             the home page would be appended to resulting dataframe)
             path (str): file path to save resulting CSV file to
             verbose (bool): True to see progress of links scraped, False to not see progress 
+            cache_dir (str): directory to cache parsed neighbor abstracts in so re-runs skip parsing, None to not cache
+            n_process (int): number of processes neighbor abstracts are parsed with, defaults to half the cpu cores, -1 for all
             
         Returns: 
-            dataframe: containing all triples from given page and triples k neighbor sources from the original page
-            new CSV file to given directory'''
+            Path: new CSV file in given directory containing all triples from given page and triples k neighbor 
+            sources from the original page, triples are written as pages finish so they are never all held in memory'''
         start_time = time.time() 
-
-        def wiki_page(link, link_list):
+        if n_process is None:
+            n_process = max(1, (os.cpu_count() or 1) // 2)
+
+        def write_pairs(fp, link, doc, doc_path=None):
+            # the cache is only an optimisation, failing to write it must not lose the page's triples
+            if doc_path is not None:
+                try:
+                    save_cached_doc(doc_path, doc)   # saved before get_doc_pairs retokenizes it
+                except Exception as e:
+                    log.warning('Could not cache %s: %s', link, e)
+
+            # any other failure only skips this page
             try:
-                if 'Categories' in link or 'Category' in link:   # remove excess sources in all wiki articles 
-                    return None, link_list 
-
-                print('Currently scraping: {}'.format(link))
-                ents = self.get_entity_pairs(self.extract_abstract(link))
-
-                for source in self.extract_text_links(link, True):
-                    link_list.append(source)
-
-                return ents,link_list
-            except:
+                data = self.get_doc_pairs(doc)
+                data.to_csv(fp, header=False, index=False)   # append and let the triples go
+                return len(data)
+            except Exception as e:
+                log.error('error on %s: %s', link, e)
+                return 0
+
+        async def wiki_page(session, semaphore, limiter, i, link):
+            try:
+                await asyncio.sleep(0.1 * (i % 10))   # stagger the first requests instead of bursting
+                async with semaphore, limiter:
+                    log.debug('Currently scraping: %s', link)
+                    return link, await self.extract_text_links_async(session, link, True)
+            except Exception:   # not bare, cancellation and KeyboardInterrupt must still stop the crawl
                 #print('page is bad')
-                return None, link_list
+                return link, None
+
+        async def crawl(sources, fp, count, visited):
+            len_prev_sources = 0 
+            connector = aiohttp.TCPConnector(limit=64, limit_per_host=8)
+            semaphore = asyncio.Semaphore(64)
+            limiter = AsyncLimiter(10, 1)   # wikipedia asks API clients for at most 10 requests per second
+
+            async with aiohttp.ClientSession(connector=connector) as session:
+                for neighbor in range(k): 
+
+                    # the new end to sources being looped through is the length of the sources from the past neighbor loop 
+                    len_curr_neighbor = len(sources) 
+
+                    # remove excess sources in all wiki articles before any request is spent on them
+                    pages = [page for page in dict.fromkeys(sources[len_prev_sources: len_curr_neighbor])
+                             if page not in visited and not ('Categories' in page or 'Category' in page)]
+                    visited.update(pages)
+                    # pages parsed on an earlier run are read from the cache and need no abstract
+                    uncached = [page for page in pages
+                                if cache_dir is None or not cached_doc_path(cache_dir, page).exists()]
+                    resolved = {}
+                    abstracts = await self.extract_abstracts_bulk_async(session, uncached, limiter, resolved)
+                    uncached = set(uncached)
+
+                    # redirects and spelling variants of an article already visited would add its triples again
+                    unique = []
+                    for page in pages:
+                        target = resolved.get(page, page)
+                        if target != page and target in visited:
+                            continue
+                        visited.add(target)
+                        unique.append(page)
+                    pages = unique
+
+                    # first all of the neighbor's requests
+                    scraped = []
+                    progress = tqdm(desc='Links Scraped', unit='', total=len(pages)) if verbose else None
+                    for future in asyncio.as_completed([wiki_page(session, semaphore, limiter, i, page)
+                                                        for i, page in enumerate(pages)]):
+                        try:
+                            link, link_list = await future
+                            if link_list is not None:
+                                sources.extend(link_list)
+                                scraped.append(link)
+                        except Exception as e:
+                            log.error('error: %s', e)
+                        progress.update(1) if verbose else None     
+                    progress.close() if verbose else None
+
+                    # cached pages are read first, one whose cache file cannot be read is fetched and parsed again
+                    from_cache = [link for link in scraped if link not in uncached]
+                    progress = tqdm(desc='Pages Parsed', unit='') if verbose else None
+                    broken = []
+                    for link in from_cache:
+                        doc = load_cached_doc(cached_doc_path(cache_dir, link), _get_nlp().vocab)
+                        if doc is None:
+                            broken.append(link)
+                            continue
+                        count += write_pairs(fp, link, doc)
+                        progress.update(1) if verbose else None
+                    if broken:
+                        abstracts.update(await self.extract_abstracts_bulk_async(session, broken, limiter))
+
+                    # then parse the neighbor's abstracts together, spread over n_process processes
+                    to_parse = [link for link in scraped if link in abstracts]
+                    if verbose:
+                        progress.total = len(from_cache) - len(broken) + len(to_parse)
+                        progress.refresh()
+                    parsed = 0
+                    try:
+                        docs = self.parse_texts([abstracts[link] for link in to_parse], n_process=n_process)
+                        for link, doc in zip(to_parse, docs):
+                            count += write_pairs(fp, link, doc, cached_doc_path(cache_dir, link) if cache_dir else None)
+                            parsed += 1
+                            progress.update(1) if verbose else None
+                    except Exception as e:
+                        # a page that breaks the pipeline ends the batched parse, the rest is parsed page by page
+                        # so only the bad page is skipped
+                        log.error('error: %s, parsing the remaining %d pages one at a time', e, len(to_parse) - parsed)
+                        for link in to_parse[parsed:]:
+                            try:
+                                doc = self.parse_text(abstracts[link])
+                            except Exception as e:
+                                log.error('error on %s: %s', link, e)
+                                continue
+                            finally:
+                                progress.update(1) if verbose else None
+                            count += write_pairs(fp, link, doc, cached_doc_path(cache_dir, link) if cache_dir else None)
+                    progress.close() if verbose else None
+
+                    # get the length of the current end of all sources (this includes primary sources, secondary sources, etc)
+                    # get length of the end of the past neighbor sources (i. e. if currently on neighbor 1 it would get the end of all the first neighbor sources)
+                    len_prev_sources = len_curr_neighbor
+
+                    log.info('Total ents: %d', count)
+                    log.info('done %d neighbor!', neighbor+1)
+                    log.info('start next loop: %d', len_prev_sources)
+                    log.info('end next loop: %d', len(sources))
+
+            return count
 
         # create empty ents and sources df 
         #sources = wiki_scrape(page_name)
         sources = self.extract_text_links(self.page_name,True)
         orig_text = self.extract_contents(self.page_name)
         ents = self.get_entity_pairs(orig_text['text'][0])
-        len_prev_sources = 0 
-        print('Extracted sources and triples from {}!'.format(self.page_name)+' # triples: {}'.format(len(ents)))
-        print('Starting recursion')
-        count = len(ents) 
-        
-        for neighbor in range(k): 
-
-            # the new end to sources being looped through is the length of the sources from the past neighbor loop 
-            len_curr_neighbor = len(sources) 
+        log.info('Extracted sources and triples from %s! # triples: %d', self.page_name, len(ents))
+        log.info('Starting recursion')
 
-            pages = list(sources[len_prev_sources: len_curr_neighbor])
-            progress = tqdm(desc='Links Scraped', unit='', total=len(pages)) if verbose else None
-            with concurrent.futures.ThreadPoolExecutor(max_workers=12) as executor:
-                future_ents = {executor.submit(wiki_page, page,sources): page for page in pages}
-                for future in concurrent.futures.as_completed(future_ents):
-                    try:
-                        data,sources = future.result()
-                        if data is not None: 
-                            ents = pd.concat([ents,data])
-                            count += len(data) 
-                    except Exception as e:
-                        print('error: {}'.format(e))
-                    progress.update(1) if verbose else None     
-            progress.close() if verbose else None
-
-            # get the length of the current end of all sources (this includes primary sources, secondary sources, etc)
-            # get length of the end of the past neighbor sources (i. e. if currently on neighbor 1 it would get the end of all the first neighbor sources)
-            len_prev_sources = len_curr_neighbor
-
-            print('-')
-            print('Total ents: {}'.format(len(ents))+' should equal sum of individual ents: {}'.format(count))
-            print('done {} neighbor!'.format(neighbor+1))
-            print('start next loop: {}'.format(len_prev_sources)) 
-            print('end next loop: {}'.format(len(sources))) 
-        
-        end_time = time.time() 
-        print('-')
-        print('total scraping time: {} minutes'.format((end_time - start_time) / 60))
-
-        # save dataframe as a CSV file
+        # save triples to a CSV file as they are extracted
         try:
             filepath = Path(path+self.page_name+str(k)+'Neighbors'+'EntityPairs.csv')  
             filepath.parent.mkdir(parents=True, exist_ok=True)  
-            ents.to_csv(filepath)
+            fp = filepath.open('w', newline='')
         except Exception as e:
-            print('Could not turn file into csv. Error: {}'.format(e))
+            log.error('Could not turn file into csv. Error: %s', e)
+            return None
 
-        return ents 
+        if cache_dir is not None:
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
 
+        with fp:
+            ents.to_csv(fp, index=False)
+            # pages are linked from many neighbors but only scraped once
+            visited = {self.page_name, orig_text['page'][0]}
+            count = run_coroutine(crawl(sources, fp, len(ents), visited))
+        
+        end_time = time.time() 
+        log.info('total scraping time: %s minutes', (end_time - start_time) / 60)
+        log.info('Saved %d triples to %s', count, filepath)
 
+        return filepath